@@ -7,33 +7,172 @@ Keeps Stockfish running between evaluations to preserve hash table.
 
 import sys
 import json
+import collections
 import struct
 import subprocess
 import threading
+import time
+import queue
+import select
+import selectors
 import os
-
-# Try to find Stockfish in common locations
-STOCKFISH_PATHS = [
-    # Windows
-    r"C:\Program Files\Stockfish\stockfish.exe",
-    r"C:\Program Files (x86)\Stockfish\stockfish.exe",
-    r"C:\stockfish\stockfish.exe",
-    os.path.expanduser(r"~\stockfish\stockfish.exe"),
-    # Linux/Mac
-    "/usr/bin/stockfish",
-    "/usr/local/bin/stockfish",
-    "/opt/homebrew/bin/stockfish",
-    os.path.expanduser("~/stockfish/stockfish"),
-]
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+# orjson is optional; it encodes straight to bytes and is much faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson:
+    encode_json = orjson.dumps
+    decode_json = orjson.loads
+else:
+    # Compact like orjson: no spaces after ',' and ':'
+    json_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+    def encode_json(obj):
+        return json_encoder.encode(obj).encode('utf-8')
+    decode_json = json.loads  # Accepts bytes directly
+
+# Try to find Stockfish in common locations (only this platform's are probed)
+if os.name == "nt":
+    STOCKFISH_PATHS = [
+        r"C:\Program Files\Stockfish\stockfish.exe",
+        r"C:\Program Files (x86)\Stockfish\stockfish.exe",
+        r"C:\stockfish\stockfish.exe",
+        os.path.expanduser(r"~\stockfish\stockfish.exe"),
+    ]
+else:
+    STOCKFISH_PATHS = [
+        "/usr/bin/stockfish",
+        "/usr/local/bin/stockfish",
+        "/opt/homebrew/bin/stockfish",
+        os.path.expanduser("~/stockfish/stockfish"),
+    ]
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chessist")
+
+# Stockfish location found by a previous session, checked first on startup
+STOCKFISH_PATH_FILE = os.path.join(CACHE_DIR, "stockfish_path")
+
+# Completed evaluations, persisted between sessions
+CACHE_MAX = 4096
+CACHE_FILE = os.path.join(CACHE_DIR, "evals.json")
+
+# Debug messages are only sent to the extension when CHESSIST_DEBUG=1
+DEBUG = os.environ.get("CHESSIST_DEBUG") == "1"
+
+# Shallower evals are too unreliable to show
+MIN_EVAL_DEPTH = 5
+
+# Seconds a newly started engine gets to answer readyok
+ENGINE_READY_TIMEOUT = 5.0
+
+# Minimum seconds between two eval messages at the same depth (~30 Hz)
+EVAL_INTERVAL = 1 / 30
+
+# The info line fast path is turned off for the session if more than
+# FAST_PATH_MAX_MISSES of FAST_PATH_WINDOW parsed lines needed the fallback
+FAST_PATH_WINDOW = 1000
+FAST_PATH_MAX_MISSES = 100
+
+# Fixed UCI commands, encoded once
+CMD_UCI = b"uci\n"
+CMD_STOP = b"stop\n"
+CMD_QUIT = b"quit\n"
+CMD_SETUP = (
+    b"setoption name Threads value 4\n"
+    b"setoption name Hash value 128\n"
+    b"setoption name MultiPV value 3\n"
+)
+CMD_ISREADY = b"isready\n"
+CMD_RESET = b"stop\nucinewgame\nisready\n"  # Clears the hash table
+
+monotonic = time.monotonic  # Bound once; read for every info line
+
+# Native messaging length prefix (native byte order)
+MESSAGE_LENGTH = struct.Struct('=I')
+pack_length = MESSAGE_LENGTH.pack  # Bound once; called for every outgoing message
+
+# Constant messages, encoded and framed once
+READY_MESSAGE = b'{"type":"ready"}'
+READY_FRAME = pack_length(len(READY_MESSAGE)) + READY_MESSAGE
+
+# Raw stdio descriptors; messages bypass the sys.stdin/sys.stdout wrappers
+STDIN_FD = sys.stdin.fileno()
+STDOUT_FD = sys.stdout.fileno()
+
+# Bytes taken per os.read(). The engine's stdout pipe is enlarged to match
+# (Linux only) so Stockfish never stalls on a full pipe while we're busy.
+READ_SIZE = 1 << 16
+PIPE_SIZE = 1 << 18
+
+# Most buffers a single os.writev() accepts; 0 where it's unavailable (Windows)
+IOV_MAX = 0
+if hasattr(os, "writev"):
+    try:
+        IOV_MAX = os.sysconf("SC_IOV_MAX")
+    except (ValueError, OSError):
+        IOV_MAX = -1
+    if IOV_MAX <= 0:
+        IOV_MAX = 16  # Limit unknown or indeterminate; POSIX guarantees 16
 
 stockfish_path = None
 stockfish_process = None
-output_thread = None
-stdout_lock = threading.Lock()
+writer_thread = None
+out_queue = queue.SimpleQueue()  # Framed messages for the writer thread; None stops it
+
+# Everything below is only touched by the main event loop. select() can't
+# poll pipes on Windows, so there small pump threads feed the loop through
+# the events queue instead.
+selector = selectors.DefaultSelector() if os.name != "nt" else None
+events = queue.SimpleQueue()
 current_eval_fen = None
 stop_requested = False
 engine_ready = False
+ready_deadline = None  # monotonic() time by which a starting engine must be ready
 analysis_in_progress = False
+pending_eval = None  # (fen, depth) to analyze once the engine is ready
+stdin_buffer = b""  # Extension input read ahead of the current message
+stockfish_output = b""  # Incomplete last line of engine output
+multipv_slots = {}  # MultiPV slot index (1-based) -> eval_data of the current search
+fast_path_enabled = True
+fast_path_lines = 0
+fast_path_misses = 0
+last_eval = None  # Latest slot 1 eval of the current search
+last_eval_sent = False  # Whether last_eval was forwarded to the extension
+sent_eval_pv = False  # Whether the last eval forwarded carried its PV
+sent_eval_depth = 0  # Depth, time and score/move of the last eval forwarded
+sent_eval_time = 0.0
+sent_eval_summary = None
+engine_options = {}  # UCI options set by the extension (part of the cache key)
+search_keys = collections.deque()  # Cache key of each running search, oldest first
+eval_cache = collections.OrderedDict()  # (fen, depth, options) -> eval data, LRU order
+eval_cache_loaded = False
+
+
+def write_cache_file(path, text):
+    """Replace a file in CACHE_DIR through a temporary file, so a host killed
+    mid-write (or two hosts quitting together) never leaves it truncated."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
 
 
 def find_stockfish():
@@ -42,97 +181,289 @@ def find_stockfish():
     if env_path and os.path.isfile(env_path):
         return env_path
 
-    for path in STOCKFISH_PATHS:
-        if os.path.isfile(path):
+    try:
+        with open(STOCKFISH_PATH_FILE, encoding="utf-8") as f:
+            path = f.read().strip()
+        if path and os.path.isfile(path):
             return path
+    except OSError:
+        pass
 
-    import shutil
+    # One PATH lookup is cheaper than probing every location below
     path = shutil.which("stockfish")
+    if not path:
+        path = next((p for p in STOCKFISH_PATHS if os.path.isfile(p)), None)
+
     if path:
-        return path
+        try:
+            write_cache_file(STOCKFISH_PATH_FILE, path)
+        except OSError:
+            pass
+
+    return path
+
+
+def options_commands():
+    """setoption commands restoring the extension's options on a new engine."""
+    return "".join(
+        f"setoption name {name} value {value}\n" for name, value in engine_options.items()
+    ).encode()
+
 
-    return None
+def options_key():
+    """Signature of the UCI options that affect evaluation results."""
+    return ";".join(f"{name}={value}" for name, value in sorted(engine_options.items()))
+
+
+def load_eval_cache():
+    """Load persisted evaluations from disk (once per session)."""
+    global eval_cache_loaded
+
+    if eval_cache_loaded:
+        return
+    eval_cache_loaded = True
+
+    try:
+        with open(CACHE_FILE, encoding="utf-8") as f:
+            entries = json.load(f)
+        for fen, depth, options, data in entries[-CACHE_MAX:]:
+            eval_cache[(fen, depth, options)] = data
+    except Exception:
+        pass
+
+
+def save_eval_cache():
+    """Persist the evaluation cache to disk."""
+    if not eval_cache_loaded:
+        return  # Never loaded, don't clobber the file from a previous session
+
+    try:
+        entries = [[*key, data] for key, data in eval_cache.items()]
+        write_cache_file(CACHE_FILE, json.dumps(entries, separators=(',', ':')))
+    except Exception:
+        pass
+
+
+def get_cached_eval(key):
+    """Return the cached evaluation for key, marking it most recently used."""
+    data = eval_cache.get(key)
+    if data is not None:
+        eval_cache.move_to_end(key)
+    return data
+
+
+def store_cached_eval(key, data):
+    """Cache a completed evaluation, evicting the least recently used entry."""
+    eval_cache[key] = data
+    eval_cache.move_to_end(key)
+    if len(eval_cache) > CACHE_MAX:
+        eval_cache.popitem(last=False)
 
 
 def send_message(message):
-    """Send a message to the extension (thread-safe)."""
-    with stdout_lock:
+    """Queue a message for the extension (thread-safe)."""
+    try:
+        encoded = encode_json(message)
+        out_queue.put(pack_length(len(encoded)) + encoded)
+    except Exception:
+        pass
+
+
+if DEBUG:
+    def dbg(message):
+        """Send a debug message to the extension."""
+        send_message({"type": "debug", "message": message})
+else:
+    def dbg(message):
+        """Debug output is disabled; skip the encoding entirely."""
+
+
+def write_output():
+    """Write queued messages to stdout, one write() per drained batch."""
+    while True:
+        frames = [out_queue.get()]
+        while frames[-1] is not None:
+            try:
+                frames.append(out_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        done = frames[-1] is None
+        if done:
+            frames.pop()
+
         try:
-            encoded = json.dumps(message).encode('utf-8')
-            sys.stdout.buffer.write(struct.pack('I', len(encoded)))
-            sys.stdout.buffer.write(encoded)
-            sys.stdout.buffer.flush()
+            write_frames(STDOUT_FD, frames)
         except Exception:
             pass
 
+        if done:
+            break
+
+
+def write_frames(fd, frames):
+    """Write a batch of frames with vectored writes where available (POSIX),
+    avoiding the copy into one buffer."""
+    if not IOV_MAX:
+        write_all(fd, b"".join(frames))
+        return
+
+    for start in range(0, len(frames), IOV_MAX):
+        batch = frames[start:start + IOV_MAX]
+        written = os.writev(fd, batch)
+        if written < sum(map(len, batch)):
+            write_all(fd, b"".join(batch)[written:])
+
+
+def write_all(fd, data):
+    """Write data to a raw fd, retrying after partial writes."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def message_buffered():
+    """Whether a complete extension message is already in stdin_buffer."""
+    if len(stdin_buffer) < 4:
+        return False
+    length, = MESSAGE_LENGTH.unpack_from(stdin_buffer)
+    return len(stdin_buffer) >= 4 + length
+
 
 def read_message():
-    """Read a message from the extension."""
+    """Read a message from the extension. Reads are done in large chunks, so
+    a burst of messages costs one syscall; the rest stays in stdin_buffer."""
+    global stdin_buffer
+
     try:
-        raw_length = sys.stdin.buffer.read(4)
-        if not raw_length:
-            return None
-        length = struct.unpack('I', raw_length)[0]
-        message = sys.stdin.buffer.read(length).decode('utf-8')
-        return json.loads(message)
+        while not message_buffered():
+            chunk = os.read(STDIN_FD, READ_SIZE)
+            if not chunk:
+                return None
+            stdin_buffer += chunk
+
+        length, = MESSAGE_LENGTH.unpack_from(stdin_buffer)
+        message = stdin_buffer[4:4 + length]
+        stdin_buffer = stdin_buffer[4 + length:]
+        return decode_json(message)
     except Exception:
         return None
 
 
+def send_commands(*commands):
+    """Send UCI commands to Stockfish in a single write."""
+    send_raw("".join(f"{command}\n" for command in commands).encode())
+
+
+def send_raw(data):
+    """Send already encoded UCI commands (e.g. CMD_STOP) to Stockfish."""
+    write_all(stockfish_process.stdin.fileno(), data)
+
+
 def kill_stockfish():
     """Kill the current Stockfish process if running."""
-    global stockfish_process, output_thread, engine_ready, analysis_in_progress
+    global stockfish_process, engine_ready, ready_deadline, analysis_in_progress, pending_eval
+    global stockfish_output, multipv_slots, last_eval, sent_eval_depth
 
     if stockfish_process:
-        try:
-            stockfish_process.stdin.write("quit\n")
-            stockfish_process.stdin.flush()
-        except Exception:
-            pass
+        if selector:
+            try:
+                selector.unregister(stockfish_process.stdout)
+            except (KeyError, ValueError):
+                pass
+
+        # poll() reaps without blocking; a crashed engine needs nothing more
+        if stockfish_process.poll() is None:
+            try:
+                send_raw(CMD_QUIT)
+            except OSError:
+                pass
 
-        try:
             stockfish_process.terminate()
-            stockfish_process.wait(timeout=1)
-        except Exception:
             try:
+                stockfish_process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
                 stockfish_process.kill()
-            except Exception:
-                pass
+                stockfish_process.wait()
 
         stockfish_process = None
 
-    output_thread = None
     engine_ready = False
+    ready_deadline = None
     analysis_in_progress = False
+    pending_eval = None
+    stockfish_output = b""
+    multipv_slots = {}
+    last_eval = None
+    sent_eval_depth = 0
+    search_keys.clear()
+
+
+def tune_stockfish_scheduling(pid):
+    """Keep Stockfish on a fixed set of cores and mark it as a throughput
+    job (Linux only). One core is left free for the browser and this host."""
+    if not hasattr(os, "sched_setaffinity"):
+        return
+
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) > 1:
+            os.sched_setaffinity(pid, cpus[:-1])
+        os.sched_setscheduler(pid, os.SCHED_BATCH, os.sched_param(0))
+    except OSError:
+        pass
+
+
+def enlarge_pipe(pipe):
+    """Grow a pipe's kernel buffer to PIPE_SIZE where supported (Linux)."""
+    if not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except OSError:
+        pass  # Above /proc/sys/fs/pipe-max-size; the default still works
 
 
 def start_stockfish():
     """Start Stockfish process and initialize UCI."""
-    global stockfish_process, output_thread, engine_ready
+    global stockfish_process, ready_deadline
 
     if stockfish_process and stockfish_process.poll() is None:
         return True  # Already running
 
+    kill_stockfish()  # Reset state left over from a crashed engine
+
     try:
         stockfish_process = subprocess.Popen(
             [stockfish_path],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.DEVNULL,
-            text=True,
-            bufsize=1
+            bufsize=0,  # Pipes are used through their raw fds only
+            # Our own fds are non-inheritable anyway (PEP 446); not asking
+            # subprocess to close the rest lets it use posix_spawn() instead
+            # of fork()+exec() on POSIX. Windows keeps the default.
+            close_fds=os.name == "nt"
         )
 
-        # Start output reader thread
-        output_thread = threading.Thread(
-            target=read_stockfish_output,
-            daemon=True
-        )
-        output_thread.start()
+        # Set before "uci" so the search threads inherit it
+        tune_stockfish_scheduling(stockfish_process.pid)
+        enlarge_pipe(stockfish_process.stdout)
+
+        # Watch the engine output from the event loop
+        if selector:
+            selector.register(stockfish_process.stdout, selectors.EVENT_READ, stockfish_process)
+        else:
+            threading.Thread(
+                target=pump_stockfish_output,
+                args=(stockfish_process,),
+                daemon=True
+            ).start()
 
         # Initialize UCI
-        stockfish_process.stdin.write("uci\n")
-        stockfish_process.stdin.flush()
+        send_raw(CMD_UCI)
+        ready_deadline = monotonic() + ENGINE_READY_TIMEOUT
 
         return True
 
@@ -143,211 +474,456 @@ def start_stockfish():
 
 def analyze_position(fen, depth):
     """Analyze a position. Keeps Stockfish running for hash table reuse."""
-    global current_eval_fen, stop_requested, analysis_in_progress
+    global current_eval_fen, stop_requested, analysis_in_progress, pending_eval, ready_deadline
 
     stop_requested = False
     current_eval_fen = fen
 
-    # Ensure Stockfish is running
-    if not stockfish_process or stockfish_process.poll() is not None:
-        if not start_stockfish():
-            return
-
-    # Wait for engine to be ready (with timeout)
-    wait_count = 0
-    while not engine_ready and wait_count < 50:
-        import time
-        time.sleep(0.1)
-        wait_count += 1
+    # Ensure Stockfish is running (no-op if it already is)
+    if not start_stockfish():
+        return
 
+    # Not initialized yet: analyze as soon as readyok arrives (latest request wins)
     if not engine_ready:
-        send_message({"type": "error", "message": "Engine not ready after timeout"})
+        pending_eval = (fen, depth)
+        if ready_deadline is None:
+            ready_deadline = monotonic() + ENGINE_READY_TIMEOUT  # Report it again
         return
 
     try:
-        # Stop any current analysis
-        if analysis_in_progress:
-            stockfish_process.stdin.write("stop\n")
-            stockfish_process.stdin.flush()
-            import time
-            time.sleep(0.05)  # Brief pause for stop to process
-
         analysis_in_progress = True
 
-        # Set position and start analysis
+        # Stop any current analysis, set position and start analysis in one
+        # batch; Stockfish finishes the old search before starting the new one
         # NOTE: We intentionally DO NOT send ucinewgame to preserve hash table
         send_message({"type": "analyzing", "fen": fen[:50], "depth": depth})
-        stockfish_process.stdin.write(f"position fen {fen}\n")
-        stockfish_process.stdin.write(f"go depth {depth}\n")
-        stockfish_process.stdin.flush()
+        send_commands("stop", f"position fen {fen}", f"go depth {depth}")
+        search_keys.append((fen, depth, options_key()))
 
     except (OSError, BrokenPipeError, IOError) as e:
-        # Pipe error - Stockfish process likely crashed, restart it
-        send_message({"type": "debug", "message": f"Pipe error, restarting engine: {str(e)}"})
-        analysis_in_progress = False
+        # Pipe error - Stockfish process likely crashed, restart it and
+        # re-analyze once the new engine is ready
+        dbg(f"Pipe error, restarting engine: {str(e)}")
         kill_stockfish()
-        # Try to restart and re-analyze
         if start_stockfish():
-            # Wait for engine to be ready
-            import time
-            wait_count = 0
-            while not engine_ready and wait_count < 30:
-                time.sleep(0.1)
-                wait_count += 1
-            if engine_ready:
-                try:
-                    analysis_in_progress = True
-                    stockfish_process.stdin.write(f"position fen {fen}\n")
-                    stockfish_process.stdin.write(f"go depth {depth}\n")
-                    stockfish_process.stdin.flush()
-                    send_message({"type": "analyzing", "fen": fen[:50], "depth": depth})
-                except Exception:
-                    analysis_in_progress = False
-                    send_message({"type": "error", "message": "Failed to restart analysis"})
+            pending_eval = (fen, depth)
     except Exception as e:
         send_message({"type": "error", "message": f"Analysis error: {str(e)}"})
-        analysis_in_progress = False
         kill_stockfish()
 
 
-def read_stockfish_output():
-    """Read output from Stockfish and send to extension."""
-    global stop_requested, engine_ready, analysis_in_progress
+def handle_stockfish_output(process, chunk):
+    """Split a chunk of Stockfish output into lines and handle each one."""
+    global stockfish_output
 
-    # Accumulate MultiPV slots; key = slot index (1-based), value = eval_data
-    multipv_slots = {}
+    if process is not stockfish_process:
+        return  # Output of an engine that has since been killed
 
-    while stockfish_process and stockfish_process.poll() is None:
-        try:
-            line = stockfish_process.stdout.readline()
-            if not line:
-                break
+    if not chunk:
+        # Engine exited; it's restarted on the next request
+        if not engine_ready:
+            send_message({"type": "error", "message": "Stockfish exited during startup"})
+        kill_stockfish()
+        return
 
-            line = line.strip()
-            if not line:
-                continue
-
-            if line == "uciok":
-                # Configure engine
-                stockfish_process.stdin.write("setoption name Threads value 4\n")
-                stockfish_process.stdin.write("setoption name Hash value 128\n")
-                stockfish_process.stdin.write("setoption name MultiPV value 3\n")
-                stockfish_process.stdin.write("isready\n")
-                stockfish_process.stdin.flush()
-
-            elif line == "readyok":
-                if not engine_ready:
-                    engine_ready = True
-                    send_message({"type": "ready"})
-
-            elif line.startswith("info depth"):
-                if stop_requested:
-                    continue
-                eval_data = parse_info(line)
-                if not eval_data or eval_data.get("depth", 0) < 5:
-                    continue
-
-                slot = eval_data.get("multipv", 1)
-                multipv_slots[slot] = eval_data
-
-                # Only broadcast when slot 1 (the best line) is received.
-                # Attach the first move from each slot so the UI can draw
-                # alternative arrows for the current position.
-                if slot == 1:
-                    # Collect best move per slot (all valid moves for this position)
-                    multi_pv_moves = []
-                    for s in [1, 2, 3]:
-                        mv = multipv_slots.get(s, {}).get("bestMove")
-                        if mv:
-                            multi_pv_moves.append(mv)
-                    eval_data["multiPvMoves"] = multi_pv_moves
-                    send_message({"type": "eval", "data": eval_data})
-
-            elif line.startswith("bestmove"):
-                analysis_in_progress = False
-                multipv_slots = {}  # Reset for next position
-                if stop_requested:
-                    continue
-                parts = line.split()
-                best_move = parts[1] if len(parts) > 1 else None
-                send_message({"type": "bestmove", "move": best_move})
-
-        except Exception as e:
-            send_message({"type": "error", "message": f"Output error: {str(e)}"})
-            break
+    *lines, stockfish_output = (stockfish_output + chunk).split(b"\n")
+    handle_line = handle_stockfish_line  # Bound once for the whole chunk
+    for line in lines:
+        line = line.strip()
+        if line:
+            handle_line(line)
+
+
+def eval_summary(eval_data):
+    """The part of an eval the extension displays."""
+    return eval_data.get("cp"), eval_data.get("mate"), eval_data.get("bestMove")
+
+
+def decode_pv(eval_data):
+    """Split the raw PV kept by parse_info() into a move list, in place."""
+    pv = eval_data.get("pv")
+    if type(pv) is bytes:
+        eval_data["pv"] = pv.decode('ascii').split()
+    return eval_data
+
+
+def send_eval(eval_data, with_pv=True):
+    """Forward an eval to the extension and remember when it was sent.
+    Without with_pv only bestMove is sent, not the whole line."""
+    global last_eval_sent, sent_eval_pv, sent_eval_depth, sent_eval_time, sent_eval_summary
+
+    if with_pv:
+        data = decode_pv(eval_data)
+    else:
+        data = {key: value for key, value in eval_data.items() if key != "pv"}
+    send_message({"type": "eval", "data": data})
+    last_eval_sent = True
+    sent_eval_pv = with_pv
+    sent_eval_depth = eval_data["depth"]
+    sent_eval_time = monotonic()
+    sent_eval_summary = eval_summary(eval_data)
+
+
+def flush_held_eval():
+    """Send a held-back eval once EVAL_INTERVAL has passed, so a quiet engine
+    doesn't leave a stale score on screen. Returns seconds until it's due."""
+    if (last_eval is None or last_eval_sent or stop_requested
+            or eval_summary(last_eval) == sent_eval_summary):
+        return None
 
-    # If we exit the loop, engine has stopped
-    engine_ready = False
-    analysis_in_progress = False
+    remaining = sent_eval_time + EVAL_INTERVAL - monotonic()
+    if remaining <= 0:
+        send_eval(last_eval, with_pv=False)
+        return None
+    return remaining
 
 
-def parse_info(line):
-    """Parse Stockfish info line into evaluation data."""
-    data = {}
+def handle_stockfish_line(line):
+    """Handle one line of Stockfish output and send results to extension."""
+    global engine_ready, ready_deadline, analysis_in_progress, pending_eval
+    global multipv_slots, last_eval, last_eval_sent, sent_eval_depth
 
-    # Extract depth
-    if "depth " in line:
-        try:
-            idx = line.index("depth ") + 6
-            end = line.index(" ", idx) if " " in line[idx:] else len(line)
-            data["depth"] = int(line[idx:end])
-        except Exception:
-            pass
+    try:
+        if line == b"uciok":
+            # Configure engine. Options the extension set are re-applied so
+            # a restarted engine matches options_key() (and the cache)
+            send_raw(CMD_SETUP + options_commands() + CMD_ISREADY)
+
+        elif line == b"readyok":
+            if not engine_ready:
+                engine_ready = True
+                ready_deadline = None
+                out_queue.put(READY_FRAME)
+
+            if pending_eval:
+                fen, depth = pending_eval
+                pending_eval = None
+                analyze_position(fen, depth)
+
+        elif line.startswith(b"info depth "):
+            if stop_requested:
+                return
+
+            # Skip shallow depths and lines without a score (currmove
+            # updates) before paying for a full parse
+            depth_end = line.find(b" ", 11)
+            if depth_end < 0:
+                return
+            depth = int(line[11:depth_end])
+            if depth < MIN_EVAL_DEPTH or b" score " not in line:
+                return
+
+            eval_data = parse_info(line, depth)
+            if not eval_data:
+                return
+
+            slot = eval_data.get("multipv", 1)
+            multipv_slots[slot] = eval_data
+
+            # Only broadcast when slot 1 (the best line) is received.
+            # Attach the first move from each slot so the UI can draw
+            # alternative arrows for the current position.
+            if slot == 1:
+                # Collect best move per slot (all valid moves for this position)
+                multi_pv_moves = []
+                for s in (1, 2, 3):
+                    mv = multipv_slots.get(s, {}).get("bestMove")
+                    if mv:
+                        multi_pv_moves.append(mv)
+                eval_data["multiPvMoves"] = multi_pv_moves
+                last_eval = eval_data
+                last_eval_sent = False
+
+                # Forward every new depth with its PV. Within a depth, only
+                # forward a changed score or move, at most every
+                # EVAL_INTERVAL and without the PV; held back evals go out
+                # from flush_held_eval() or at bestmove
+                if eval_data["depth"] != sent_eval_depth:
+                    send_eval(eval_data)
+                elif (monotonic() - sent_eval_time >= EVAL_INTERVAL
+                        and eval_summary(eval_data) != sent_eval_summary):
+                    send_eval(eval_data, with_pv=False)
+
+        elif line.startswith(b"bestmove"):
+            analysis_in_progress = False
+            multipv_slots = {}  # Reset for next position
+            parts = line.split()
+            best_move = parts[1].decode('ascii') if len(parts) > 1 else None
+
+            # Cache the result only if the search reached its full depth
+            key = search_keys.popleft() if search_keys else None
+            if key and last_eval and last_eval["depth"] >= key[1]:
+                store_cached_eval(key, dict(decode_pv(last_eval), bestMove=best_move))
+            final_eval = last_eval if not (last_eval_sent and sent_eval_pv) else None
+            last_eval = None
+            sent_eval_depth = 0
+
+            if stop_requested:
+                return
+            if final_eval:
+                send_eval(final_eval)  # The final eval and its PV must not be dropped
+            send_message({"type": "bestmove", "move": best_move})
 
-    # Extract multipv slot index
-    if "multipv " in line:
-        try:
-            idx = line.index("multipv ") + 8
-            end = line.index(" ", idx) if " " in line[idx:] else len(line)
-            data["multipv"] = int(line[idx:end])
-        except Exception:
-            pass
+    except Exception as e:
+        send_message({"type": "error", "message": f"Output error: {str(e)}"})
 
-    # Extract score
-    if "score cp " in line:
-        try:
-            idx = line.index("score cp ") + 9
-            end_idx = idx
-            while end_idx < len(line) and (line[end_idx].isdigit() or line[end_idx] == '-'):
-                end_idx += 1
-            data["cp"] = int(line[idx:end_idx])
-        except Exception:
-            pass
-    elif "score mate " in line:
-        try:
-            idx = line.index("score mate ") + 11
-            end_idx = idx
-            while end_idx < len(line) and (line[end_idx].isdigit() or line[end_idx] == '-'):
-                end_idx += 1
-            data["mate"] = int(line[idx:end_idx])
-        except Exception:
-            pass
+
+def parse_info(line, depth=None):
+    """Parse Stockfish info line (bytes) into evaluation data. depth is
+    the line's depth if the caller already read it."""
+    global fast_path_enabled, fast_path_lines, fast_path_misses
+
+    if not fast_path_enabled:
+        return parse_info_tokens(line)
+
+    data = parse_info_fast(line, depth)
+    if data is None:
+        data = parse_info_tokens(line)
+        if data is not None:
+            fast_path_misses += 1
+
+    fast_path_lines += 1
+    if fast_path_lines == FAST_PATH_WINDOW:
+        # Give up on the fast path if this engine's lines rarely fit it
+        fast_path_enabled = fast_path_misses <= FAST_PATH_MAX_MISSES
+        fast_path_lines = fast_path_misses = 0
+
+    return data
+
+
+def parse_info_fast(line, depth=None):
+    """Parse an info line in Stockfish's usual layout by token position:
+    info depth D seldepth S multipv M score cp|mate V nodes N nps N ... pv ...
+    Returns None if the line has any other shape."""
+    head, _, pv = line.partition(b" pv ")
+    tokens = head.split()
+    if (len(tokens) < 14 or tokens[1] != b"depth" or tokens[5] != b"multipv"
+            or tokens[7] != b"score" or tokens[12] != b"nps"):
+        return None
+
+    try:
+        data = {
+            "depth": int(tokens[2]) if depth is None else depth,
+            "multipv": int(tokens[6]),
+            "cp" if tokens[8] == b"cp" else "mate": int(tokens[9]),
+            "nps": int(tokens[13]),
+        }
+    except ValueError:
+        return None
+
+    if pv:
+        data["bestMove"] = pv.partition(b" ")[0].decode('ascii')
+        data["pv"] = pv  # Raw bytes; only split by decode_pv() when sent
+
+    return data
+
+
+def parse_info_tokens(line):
+    """Parse any info line by walking its "key value" tokens."""
+    head, _, pv = line.partition(b" pv ")
+
+    # Walk "key value" pairs; unknown keys and their values are skipped
+    data = {}
+    tokens = iter(head.split())
+    try:
+        for token in tokens:
+            if token == b"depth":
+                data["depth"] = int(next(tokens))
+            elif token == b"multipv":
+                data["multipv"] = int(next(tokens))
+            elif token == b"score":
+                score_type = next(tokens)
+                data["cp" if score_type == b"cp" else "mate"] = int(next(tokens))
+            elif token == b"nps":
+                data["nps"] = int(next(tokens))
+    except (StopIteration, ValueError):
+        return None  # Truncated or malformed line
+
+    if "depth" not in data or ("cp" not in data and "mate" not in data):
+        return None
 
     # Extract PV (Principal Variation)
-    if " pv " in line:
+    if pv:
+        data["bestMove"] = pv.partition(b" ")[0].decode('ascii')
+        data["pv"] = pv  # Raw bytes; only split by decode_pv() when sent
+
+    return data
+
+
+def handle_message(message):
+    """Handle a message from the extension. Returns False to quit."""
+    global stop_requested, analysis_in_progress, pending_eval
+
+    msg_type = message.get("type")
+
+    if msg_type == "evaluate":
+        fen = message.get("fen")
+        depth = message.get("depth", 18)
+        if not fen:
+            return True
+
+        # Repeated position: answer from the cache without the engine
+        cached = get_cached_eval((fen, depth, options_key()))
+        if cached:
+            pending_eval = None
+            if analysis_in_progress:
+                stop_requested = True
+                analysis_in_progress = False
+                try:
+                    send_raw(CMD_STOP)
+                except Exception:
+                    pass
+            send_message({"type": "eval", "data": cached})
+            send_message({"type": "bestmove", "move": cached["bestMove"]})
+        else:
+            analyze_position(fen, depth)
+
+    elif msg_type == "stop":
+        stop_requested = True
+        analysis_in_progress = False
+        pending_eval = None
+        if stockfish_process and stockfish_process.poll() is None:
+            try:
+                send_raw(CMD_STOP)
+            except (OSError, BrokenPipeError, IOError):
+                # Process already dead, restart it
+                kill_stockfish()
+                start_stockfish()
+            except Exception:
+                pass
+
+    elif msg_type == "reset":
+        # Full reset - send ucinewgame to clear hash table
+        stop_requested = True
+        analysis_in_progress = False
+        pending_eval = None
+        if stockfish_process and stockfish_process.poll() is None:
+            try:
+                send_raw(CMD_RESET)
+                dbg("Engine reset (ucinewgame)")
+            except Exception:
+                # If pipe fails, do a full restart
+                kill_stockfish()
+                start_stockfish()
+                dbg("Engine reset (restarted)")
+        else:
+            start_stockfish()
+            dbg("Engine reset (restarted)")
+
+    elif msg_type == "set_option":
+        # Set UCI option (e.g., Skill Level)
+        name = message.get("name")
+        value = message.get("value")
+        if name and value is not None and stockfish_process and stockfish_process.poll() is None:
+            try:
+                send_commands(f"setoption name {name} value {value}")
+                engine_options[name] = value
+                dbg(f"Set option {name} = {value}")
+            except Exception as e:
+                send_message({"type": "error", "message": f"Failed to set option: {str(e)}"})
+
+    elif msg_type == "quit":
+        return False
+
+    return True
+
+
+def pump_messages():
+    """Forward extension messages to the event loop (Windows only)."""
+    while True:
+        message = read_message()
+        events.put((None, message))
+        if message is None:
+            break
+
+
+def pump_stockfish_output(process):
+    """Forward Stockfish output to the event loop (Windows only)."""
+    fd = process.stdout.fileno()
+    while True:
         try:
-            idx = line.index(" pv ") + 4
-            pv_moves = line[idx:].split()
-            if pv_moves:
-                data["bestMove"] = pv_moves[0]
-                data["pv"] = pv_moves
-        except Exception:
-            pass
+            chunk = os.read(fd, READ_SIZE)
+        except OSError:
+            chunk = b""
+        events.put((process, chunk))
+        if not chunk:
+            break
+
 
-    # Extract nps
-    if "nps " in line:
+def next_events(timeout=None):
+    """Wait up to timeout seconds for input and return everything that is
+    ready: (process, chunk) for Stockfish output and (None, message) for
+    extension messages."""
+    if not selector:
         try:
-            idx = line.index("nps ") + 4
-            end = line.index(" ", idx) if " " in line[idx:] else len(line)
-            data["nps"] = int(line[idx:end])
-        except Exception:
-            pass
+            ready = [events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                ready.append(events.get_nowait())
+            except queue.Empty:
+                return drop_superseded(ready)
+
+    ready = []
+    for key, _ in selector.select(timeout):
+        if key.data is None:
+            ready.append((None, read_message()))
+            # Take every message that is already waiting as well; buffered
+            # ones must be drained here since select() can't see them
+            while ready[-1][1] is not None and (
+                    message_buffered() or select.select([STDIN_FD], [], [], 0)[0]):
+                ready.append((None, read_message()))
+        else:
+            ready.append((key.data, os.read(key.fd, READ_SIZE)))
+    return drop_superseded(ready)
+
+
+def run_timers():
+    """Run whatever is due; returns seconds until the next timer, or None."""
+    timeouts = [t for t in (check_ready_timeout(), flush_held_eval()) if t is not None]
+    return min(timeouts, default=None)
+
+
+def check_ready_timeout():
+    """Report a started engine that hasn't answered readyok in time and drop
+    the request waiting for it. The engine is left running, so a late readyok
+    still brings it up. Returns seconds left until the deadline."""
+    global ready_deadline, pending_eval
+
+    if ready_deadline is None:
+        return None
+
+    remaining = ready_deadline - monotonic()
+    if remaining <= 0:
+        send_message({"type": "error", "message": "Engine not ready after timeout"})
+        ready_deadline = None
+        pending_eval = None
+        return None
+    return remaining
 
-    return data if ("cp" in data or "mate" in data) else None
+
+def is_evaluate(event):
+    process, message = event
+    # Anything but an object is left for handle_message() to report
+    return process is None and isinstance(message, dict) and message.get("type") == "evaluate"
+
+
+def drop_superseded(ready):
+    """Drop evaluate requests that a later one in the same batch replaces;
+    their results would be stale before they arrive (latest request wins)."""
+    last = None
+    for i, event in enumerate(ready):
+        if is_evaluate(event):
+            last = i
+    return [event for i, event in enumerate(ready) if i == last or not is_evaluate(event)]
 
 
 def main():
-    global stockfish_path, stop_requested, analysis_in_progress
+    global stockfish_path, writer_thread
+
+    writer_thread = threading.Thread(target=write_output, daemon=True)
+    writer_thread.start()
 
     # Find Stockfish
     stockfish_path = find_stockfish()
@@ -357,82 +933,39 @@ def main():
             "type": "error",
             "message": "Stockfish not found. Install Stockfish and add to PATH or set STOCKFISH_PATH."
         })
+        out_queue.put(None)
+        writer_thread.join()
         return
 
     send_message({"type": "started", "path": stockfish_path})
 
-    # Start Stockfish immediately
-    start_stockfish()
-
-    # Main message loop
-    while True:
-        try:
-            message = read_message()
-            if message is None:
-                break
+    if selector:
+        selector.register(STDIN_FD, selectors.EVENT_READ)
+    else:
+        threading.Thread(target=pump_messages, daemon=True).start()
 
-            msg_type = message.get("type")
-
-            if msg_type == "evaluate":
-                fen = message.get("fen")
-                depth = message.get("depth", 18)
-                if fen:
-                    analyze_position(fen, depth)
-
-            elif msg_type == "stop":
-                stop_requested = True
-                analysis_in_progress = False
-                if stockfish_process and stockfish_process.poll() is None:
-                    try:
-                        stockfish_process.stdin.write("stop\n")
-                        stockfish_process.stdin.flush()
-                    except (OSError, BrokenPipeError, IOError):
-                        # Process already dead, restart it
-                        kill_stockfish()
-                        start_stockfish()
-                    except Exception:
-                        pass
-
-            elif msg_type == "reset":
-                # Full reset - send ucinewgame to clear hash table
-                stop_requested = True
-                analysis_in_progress = False
-                if stockfish_process and stockfish_process.poll() is None:
-                    try:
-                        stockfish_process.stdin.write("stop\n")
-                        stockfish_process.stdin.write("ucinewgame\n")
-                        stockfish_process.stdin.write("isready\n")
-                        stockfish_process.stdin.flush()
-                        send_message({"type": "debug", "message": "Engine reset (ucinewgame)"})
-                    except Exception:
-                        # If pipe fails, do a full restart
-                        kill_stockfish()
-                        start_stockfish()
-                        send_message({"type": "debug", "message": "Engine reset (restarted)"})
-                else:
-                    start_stockfish()
-                    send_message({"type": "debug", "message": "Engine reset (restarted)"})
-
-            elif msg_type == "set_option":
-                # Set UCI option (e.g., Skill Level)
-                name = message.get("name")
-                value = message.get("value")
-                if name and value is not None and stockfish_process and stockfish_process.poll() is None:
-                    try:
-                        stockfish_process.stdin.write(f"setoption name {name} value {value}\n")
-                        stockfish_process.stdin.flush()
-                        send_message({"type": "debug", "message": f"Set option {name} = {value}"})
-                    except Exception as e:
-                        send_message({"type": "error", "message": f"Failed to set option: {str(e)}"})
-
-            elif msg_type == "quit":
-                break
+    # Start Stockfish immediately, and read the cache while it initializes
+    start_stockfish()
+    load_eval_cache()
 
-        except Exception as e:
-            send_message({"type": "error", "message": str(e)})
+    # Main event loop: extension messages and engine output, one at a time
+    running = True
+    while running:
+        for process, payload in next_events(run_timers()):
+            try:
+                if process:
+                    handle_stockfish_output(process, payload)
+                elif payload is None or not handle_message(payload):
+                    running = False
+                    break
+            except Exception as e:
+                send_message({"type": "error", "message": str(e)})
 
     # Cleanup
     kill_stockfish()
+    save_eval_cache()
+    out_queue.put(None)
+    writer_thread.join()
 
 
 if __name__ == "__main__":